@@ -1,17 +1,21 @@
 import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
 from os import path
 from typing import List, Dict, Union, Tuple
 
 import numpy as np
 import torch
 import torch.utils.tensorboard as tb
-from PIL import Image
-from sklearn.metrics import mean_squared_error, mean_absolute_error
 from tqdm.auto import trange, tqdm
 import torchvision.transforms as transforms
 
-from .models import CNNClassifier, save_model, load_model
-from .utils import load_data, save_dict, ConfusionMatrix, get_image_transform
+from .models import CNNClassifier, save_model, load_model, load_model_data, FOLDER_PATH_KEY
+from .utils import load_data, save_dict, load_dict, ConfusionMatrix, ImagePathDataset
+
+# allow TF32 matmuls so compiled kernels can use tensor cores (torch >= 1.12)
+if hasattr(torch, 'set_float32_matmul_precision'):
+    torch.set_float32_matmul_precision('high')
 
 
 def train(
@@ -24,7 +28,7 @@ def train(
         optimizer_name: str = "adamw",
         n_epochs: int = 65,
         batch_size: int = 64,
-        num_workers: int = 2,
+        num_workers: int = None,
         scheduler_mode: str = 'min_mse',
         debug_mode: bool = False,
         device=None,
@@ -53,7 +57,8 @@ def train(
     :param optimizer_name: optimizer used for training. Can be `adam, adamw, sgd`
     :param n_epochs: number of epochs of training
     :param batch_size: size of batches to use
-    :param num_workers: number of workers (processes) to use for data loading
+    :param num_workers: number of workers (processes) to use for data loading.
+                        If None, defaults to min(8, cpu count); tune it, too many workers can also regress
     :param scheduler_mode: scheduler mode to use for the learning rate scheduler. Can be `min_loss, min_mse, max_acc, max_val_acc, max_val_mcc`
     :param use_cpu: whether to use the CPU for training
     :param debug_mode: whether to use debug mode (cpu and 0 workers)
@@ -69,9 +74,14 @@ def train(
         device = torch.device('cuda' if torch.cuda.is_available() and not (use_cpu or debug_mode) else 'cpu')
     # print(device)
 
-    # num_workers 0 if debug_mode
+    # batch and image sizes are fixed, so let cudnn benchmark the conv kernels once
+    torch.backends.cudnn.benchmark = True
+
+    # num_workers 0 if debug_mode, otherwise default to one per core (capped at 8)
     if debug_mode:
         num_workers = 0
+    elif num_workers is None:
+        num_workers = min(8, os.cpu_count())
 
     # Tensorboard
     global_step = 0
@@ -95,8 +105,10 @@ def train(
 
     # train_logger = tb.SummaryWriter(path.join(log_dir, 'train', name_model), flush_secs=1)
     # valid_logger = tb.SummaryWriter(path.join(log_dir, 'valid', name_model), flush_secs=1)
-    train_logger = tb.SummaryWriter(path.join(log_dir, name_model), flush_secs=1)
+    train_logger = tb.SummaryWriter(path.join(log_dir, name_model), flush_secs=30)
     valid_logger = train_logger
+    # single background thread so tensorboard writes do not stall the epoch loop
+    log_pool = ThreadPoolExecutor(max_workers=1)
 
     # Model
     dict_model.update(dict_param)
@@ -110,6 +122,13 @@ def train(
     #     epoch=0,
     # ))
     model = model.to(device)
+    # nhwc layout maps better onto tensor-core conv kernels than the default nchw
+    model = model.to(memory_format=torch.channels_last)
+    # keep a handle to the eager module for saving (torch.compile wraps it)
+    base_model = model
+    # jit-compile the model through inductor if available (torch >= 2.0)
+    if hasattr(torch, 'compile'):
+        model = torch.compile(model, mode='reduce-overhead')
 
     # Loss
     loss_gender = torch.nn.BCEWithLogitsLoss().to(device)  # sigmoid + BCELoss (good for 2 classes classification)
@@ -137,127 +156,176 @@ def train(
     else:
         raise Exception("Optimizer not configured")
 
-    if scheduler_mode in ["min_loss", 'min_mse']:
-        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=scheduler_patience)
-    elif scheduler_mode in ["max_acc", "max_val_acc", "max_val_mcc"]:
-        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'max', patience=scheduler_patience)
-    else:
-        raise Exception("Optimizer not configured")
+    # metric tracked by the scheduler and checkpointing: model dict key, getter and direction per mode
+    # (the getters are closures over the per-epoch metrics computed below)
+    scheduler_metrics = {
+        'min_loss': ('train_loss', lambda: train_loss, 'min'),
+        'min_mse': ('val_mse_age', lambda: val_mse_age, 'min'),
+        'max_acc': ('train_acc', lambda: train_cm.global_accuracy, 'max'),
+        'max_val_acc': ('val_acc', lambda: val_cm.global_accuracy, 'max'),
+        'max_val_mcc': ('val_mcc', lambda: val_cm.matthews_corrcoef, 'max'),
+    }
+    if scheduler_mode not in scheduler_metrics:
+        raise Exception("Scheduler mode not configured")
+    metric_key, metric_fn, metric_direction = scheduler_metrics[scheduler_mode]
+    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, metric_direction, patience=scheduler_patience)
+
+    # mixed precision: scaler is a no-op on cpu, autocast only enabled on cuda
+    scaler = torch.cuda.amp.GradScaler(enabled=device.type == 'cuda')
 
     met = None
+    last_met = None
+    # base name for saved checkpoints, built once (str(name_dict) work is O(params))
+    base_name_path = str(list(name_dict.values()))[1:-1].replace(',', '_').replace("'", '').replace(' ', '')
     # print(f"{log_dir}/{name_model}")
-    for epoch in (p_bar := trange(n_epochs)):
-        p_bar.set_description(f"{name_model} -> {met if met is not None else ''}")
-        # print(epoch)
-        train_loss = []
-        train_loss_gender = []
-        train_loss_age = []
-        train_cm = ConfusionMatrix(size=2, name='train')
-
-        # Start training: train mode and freeze bert
-        model.train()
-        for img, age, gender in loader_train:
-            # To device
-            img, age, gender = img.to(device), age.to(device), gender.to(device)
-
-            # Compute loss and update parameters
-            pred = model(img)
-            loss_val_gender = loss_gender(pred[:, 0], gender)
-            loss_val_age = loss_age(pred[:, 1], age)
-            loss_val = loss_val_gender + loss_age_weight * loss_val_age
-
-            # Do back propagation
-            optimizer.zero_grad()
-            loss_val.backward()
-            optimizer.step()
-
-            # Add train loss and accuracy
-            train_loss.append(loss_val.cpu().detach().numpy())
-            train_loss_age.append(loss_val_age.cpu().detach().numpy())
-            train_loss_gender.append(loss_val_gender.cpu().detach().numpy())
-            train_cm.add(preds=(pred[:, 0] > 0).float(), labels=gender)
-
-        # Evaluate the model
-        val_cm = ConfusionMatrix(size=2, name='val')
-        val_mse_age = []
-        model.eval()
-        with torch.no_grad():
-            for img, age, gender in loader_valid:
-                # To device
-                img, age, gender = img.to(device), age.to(device), gender.to(device)
-                pred = model(img)
-
-                val_cm.add((pred[:, 0] > 0).float(), gender)
-                val_mse_age.append(loss_age(pred[:, 1], age).cpu().detach().numpy())
-
-        # mean loss values
-        train_loss = np.mean(train_loss)
-        train_loss_gender = np.mean(train_loss_gender)
-        train_loss_age = np.mean(train_loss_age)
-        # mse
-        val_mse_age = np.mean(val_mse_age)
-
-        # Step the scheduler to change the learning rate
-        is_better = False
-        if scheduler_mode == "min_loss":
-            met = train_loss
-            if (best_met := dict_model.get('train_loss', None)) is not None:
-                is_better = met <= best_met
-        elif scheduler_mode == "min_mse":
-            met = val_mse_age
-            if (best_met := dict_model.get('val_mse_age', None)) is not None:
-                is_better = met <= best_met
-        elif scheduler_mode == "max_acc":
-            met = train_cm.global_accuracy
-            if (best_met := dict_model.get('train_acc', None)) is not None:
-                is_better = met >= best_met
-        elif scheduler_mode == "max_val_acc":
-            met = val_cm.global_accuracy
-            if (best_met := dict_model.get('val_acc', None)) is not None:
-                is_better = met >= best_met
-        elif scheduler_mode == 'max_val_mcc':
-            met = val_cm.matthews_corrcoef
-            if (best_met := dict_model.get('val_mcc', None)) is not None:
-                is_better = met >= best_met
-        else:
-            met = None
-
-        if met is not None:
+    try:
+        for epoch in (p_bar := trange(n_epochs)):
+            # only rebuild the progress-bar description when the tracked metric changed
+            if epoch == 0 or met != last_met:
+                p_bar.set_description(f"{name_model} -> {met if met is not None else ''}")
+                last_met = met
+            # print(epoch)
+            # running sums kept on device so the batch loop never syncs with the host
+            train_loss_sum = torch.zeros((), device=device)
+            train_loss_gender_sum = torch.zeros((), device=device)
+            train_loss_age_sum = torch.zeros((), device=device)
+            train_samples = 0
+            train_cm = ConfusionMatrix(size=2, name='train')
+
+            # Start training: train mode and freeze bert
+            model.train()
+            for img, age, gender in loader_train:
+                # To device (async copy from pinned memory, nhwc to match the model layout)
+                img = img.to(device, non_blocking=True).contiguous(memory_format=torch.channels_last)
+                age = age.to(device, non_blocking=True)
+                gender = gender.to(device, non_blocking=True)
+
+                # Compute loss and update parameters (forward and losses under autocast)
+                with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=device.type == 'cuda'):
+                    pred = model(img)
+                    # slice and cast to fp32 once so the losses see full-precision inputs
+                    gender_logit = pred[:, 0].float()
+                    age_pred = pred[:, 1].float()
+                    loss_val_gender = loss_gender(gender_logit, gender)
+                    loss_val_age = loss_age(age_pred, age)
+                    loss_val = loss_val_gender + loss_age_weight * loss_val_age
+
+                # Do back propagation (set_to_none avoids an extra sweep over gradient memory)
+                optimizer.zero_grad(set_to_none=True)
+                scaler.scale(loss_val).backward()
+                scaler.step(optimizer)
+                scaler.update()
+
+                # Add train loss and accuracy (weighted by batch size, transferred once per epoch)
+                train_loss_sum += loss_val.detach() * img.size(0)
+                train_loss_age_sum += loss_val_age.detach() * img.size(0)
+                train_loss_gender_sum += loss_val_gender.detach() * img.size(0)
+                train_samples += img.size(0)
+                train_cm.add(preds=(gender_logit > 0).float(), labels=gender)
+
+            # Evaluate the model
+            val_cm = ConfusionMatrix(size=2, name='val')
+            val_mse_age_sum = torch.zeros((), device=device)
+            val_samples = 0
+            model.eval()
+            with torch.inference_mode():
+                for img, age, gender in loader_valid:
+                    # To device (async copy from pinned memory, nhwc to match the model layout)
+                    img = img.to(device, non_blocking=True).contiguous(memory_format=torch.channels_last)
+                    age = age.to(device, non_blocking=True)
+                    gender = gender.to(device, non_blocking=True)
+                    with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=device.type == 'cuda'):
+                        pred = model(img)
+                    # slice and cast to fp32 once, as in the training loop
+                    gender_logit = pred[:, 0].float()
+                    age_pred = pred[:, 1].float()
+
+                    val_cm.add((gender_logit > 0).float(), gender)
+                    val_mse_age_sum += loss_age(age_pred, age).detach() * img.size(0)
+                    val_samples += img.size(0)
+
+            # mean loss values (single device to host transfer per epoch)
+            train_loss = (train_loss_sum / train_samples).item()
+            train_loss_gender = (train_loss_gender_sum / train_samples).item()
+            train_loss_age = (train_loss_age_sum / train_samples).item()
+            # mse
+            val_mse_age = (val_mse_age_sum / val_samples).item()
+
+            # Step the scheduler to change the learning rate
+            met = metric_fn()
+            is_better = False
+            if (best_met := dict_model.get(metric_key, None)) is not None:
+                is_better = met <= best_met if metric_direction == 'min' else met >= best_met
+
             scheduler.step(met)
 
-        global_step += 1
-        if train_logger is not None:
-            suffix = 'train'
-            train_logger.add_scalar(f'loss_{suffix}', train_loss, global_step=global_step)
-            train_logger.add_scalar(f'loss_age_{suffix}', train_loss_age, global_step=global_step)
-            train_logger.add_scalar(f'loss_gender_{suffix}', train_loss_gender, global_step=global_step)
-            log_confussion_matrix(train_logger, train_cm, global_step, suffix=suffix)
-            # validation log
-            suffix = 'val'
-            valid_logger.add_scalar(f'mse_age_{suffix}', val_mse_age, global_step=global_step)
-            log_confussion_matrix(valid_logger, val_cm, global_step, suffix=suffix)
-            # lr
-            train_logger.add_scalar('lr', optimizer.param_groups[0]['lr'], global_step=global_step)
-
-        # Save the model
-        if (epoch % steps_save == steps_save - 1) or is_better:
-            d = dict_model if is_better else dict_model.copy()
-
-            # print(f"Best val acc {epoch}: {val_acc}")
-            d["epoch"] = epoch + 1
-            # metrics
-            d["train_loss"] = train_loss
-            d["val_mse_age"] = val_mse_age
-            d["train_acc"] = train_cm.global_accuracy
-            d["val_acc"] = val_cm.global_accuracy
-            d["val_mcc"] = val_cm.matthews_corrcoef
-
-            name_path = str(list(name_dict.values()))[1:-1].replace(',', '_').replace("'", '').replace(' ', '')
-            # name_path = f"{d['val_acc']:.2f}_{name_path}"
-            # if periodic save, then include epoch
-            if not is_better:
-                name_path = f"{name_path}_{epoch + 1}"
-            save_model(model, save_path, name_path, param_dicts=d)
+            global_step += 1
+            if train_logger is not None:
+                # hand the metrics to the logging thread; the cm objects are rebuilt
+                # next epoch so they can be used from the background safely
+                log_pool.submit(
+                    _log_epoch,
+                    train_logger, valid_logger,
+                    {
+                        'loss_train': train_loss,
+                        'loss_age_train': train_loss_age,
+                        'loss_gender_train': train_loss_gender,
+                        'lr': optimizer.param_groups[0]['lr'],
+                    },
+                    {'mse_age_val': val_mse_age},
+                    train_cm, val_cm, global_step,
+                ).add_done_callback(_raise_log_exception)
+
+            # Save the model
+            if (epoch % steps_save == steps_save - 1) or is_better:
+                d = dict_model if is_better else dict_model.copy()
+
+                # print(f"Best val acc {epoch}: {val_acc}")
+                d["epoch"] = epoch + 1
+                # metrics
+                d["train_loss"] = train_loss
+                d["val_mse_age"] = val_mse_age
+                d["train_acc"] = train_cm.global_accuracy
+                d["val_acc"] = val_cm.global_accuracy
+                d["val_mcc"] = val_cm.matthews_corrcoef
+
+                # name_path = f"{d['val_acc']:.2f}_{base_name_path}"
+                # if periodic save, then include epoch
+                name_path = base_name_path if is_better else f"{base_name_path}_{epoch + 1}"
+                save_model(base_model, save_path, name_path, param_dicts=d)
+    finally:
+        # make sure all pending tensorboard writes are done even if training fails
+        log_pool.shutdown(wait=True)
+
+
+def _raise_log_exception(future) -> None:
+    """
+    Done callback for the logging futures: re-raises any exception from the
+    logging thread so failed tensorboard writes are reported instead of dropped
+    :param future: completed future returned by the logging pool
+    """
+    if future.exception() is not None:
+        raise future.exception()
+
+
+def _log_epoch(train_logger, valid_logger, train_scalars: Dict, valid_scalars: Dict,
+               train_cm: ConfusionMatrix, val_cm: ConfusionMatrix, global_step: int) -> None:
+    """
+    Writes the metrics of one epoch to tensorboard (runs on the logging thread)
+    :param train_logger: tensorboard logger for the training metrics
+    :param valid_logger: tensorboard logger for the validation metrics
+    :param train_scalars: dictionary of training scalars to log (name -> value)
+    :param valid_scalars: dictionary of validation scalars to log (name -> value)
+    :param train_cm: confusion matrix of the training epoch
+    :param val_cm: confusion matrix of the validation epoch
+    :param global_step: global step for the loggers
+    """
+    for k, v in train_scalars.items():
+        train_logger.add_scalar(k, v, global_step=global_step)
+    log_confussion_matrix(train_logger, train_cm, global_step, suffix='train')
+    for k, v in valid_scalars.items():
+        valid_logger.add_scalar(k, v, global_step=global_step)
+    log_confussion_matrix(valid_logger, val_cm, global_step, suffix='val')
 
 
 def log_confussion_matrix(logger, confussion_matrix: ConfusionMatrix, global_step: int, suffix=''):
@@ -317,27 +385,63 @@ def test(
     if debug_mode:
         num_workers = 0
 
+    # loaders are shared across models (same data, batch size and transforms),
+    # so the dataset scan and worker spawn happen only once
+    loader_train, loader_valid, loader_test = load_data(
+        dataset_path=data_path,
+        num_workers=num_workers,
+        batch_size=batch_size,
+        drop_last=False,
+        random_seed=4444,
+        train_transforms=transforms,
+        test_transforms=transforms,
+        use_cache=use_cache,
+    )
+
+    # keys of the model dict that do not bear on the architecture: training
+    # hyper-parameters (all 'train_'-prefixed) plus stored metrics and the folder
+    # name; everything else goes into the comparison, so a constructor argument
+    # like in_stride (which changes no weight shape) still forces a rebuild
+    non_arch_keys = {
+        FOLDER_PATH_KEY, 'epoch',
+        'val_mse_age', 'val_acc', 'val_mse', 'val_mae', 'val_mcc',
+        'test_acc', 'test_mse', 'test_mae', 'test_mcc',
+    }
+
     # get model names from folder
     model = None
+    base_model = None
+    last_arch = None
     list_all = []
     paths = list(Path(save_path).glob('*'))
     for folder_path in tqdm(paths):
         print_v(f"Testing {folder_path.name}")
 
-        # load model and data loader
-        del model
-        model, dict_model = load_model(folder_path)
-        model = model.to(device).eval()
-        loader_train, loader_valid, loader_test = load_data(
-            dataset_path=data_path,
-            num_workers=num_workers,
-            batch_size=batch_size,
-            drop_last=False,
-            random_seed=4444,
-            train_transforms=transforms,
-            test_transforms=transforms,
-            use_cache=use_cache,
-        )
+        # load model
+        dict_model = load_dict(f"{folder_path.absolute()}/{folder_path.name}.dict.pickle")
+        dict_model[FOLDER_PATH_KEY] = folder_path.name
+        arch = {k: v for k, v in dict_model.items() if not k.startswith('train_') and k not in non_arch_keys}
+        reused = False
+        if base_model is not None and arch == last_arch:
+            # same architecture: copy the checkpoint into the existing parameter tensors
+            try:
+                load_model_data(base_model, f"{folder_path.absolute()}/{folder_path.name}.th")
+                reused = True
+            except RuntimeError:
+                # shape mismatch the dict comparison could not see: rebuild below
+                pass
+        if not reused:
+            # different architecture: rebuild the module and release the old allocations
+            del model, base_model
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            base_model, dict_model = load_model(folder_path)
+            base_model = base_model.to(device).to(memory_format=torch.channels_last).eval()
+            model = base_model
+            # jit-compile the model for inference if available (fixed shapes, so autotune pays off)
+            if hasattr(torch, 'compile'):
+                model = torch.compile(model, mode='max-autotune')
+        last_arch = arch
 
         # start testing
         train_mse = []
@@ -349,55 +453,53 @@ def test(
         test_mse = []
         test_mae = []
         test_cm = []
+        def run_loader(loader, cm: ConfusionMatrix) -> Tuple[float, float]:
+            """
+            Runs the model over a loader accumulating age mse/mae on device
+            :param loader: dataloader to evaluate
+            :param cm: confusion matrix updated with the gender predictions
+            :return: (mse, mae) of the age predictions
+            """
+            mse_sum = torch.zeros((), device=device)
+            mae_sum = torch.zeros((), device=device)
+            samples = 0
+            for img, age, gender in loader:
+                img = img.to(device, non_blocking=True).contiguous(memory_format=torch.channels_last)
+                age = age.to(device, non_blocking=True)
+                with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=device.type == 'cuda'):
+                    pred = model(img)
+
+                # slice and cast to fp32 once
+                gender_logit = pred[:, 0].float()
+                age_pred = pred[:, 1].float()
+
+                # age metrics as on-device sums, only the final scalars are transferred
+                mse_sum += torch.nn.functional.mse_loss(age_pred, age, reduction='sum')
+                mae_sum += (age_pred - age).abs().sum()
+                samples += img.size(0)
+                cm.add(preds=(gender_logit > 0).float(), labels=gender)
+            return (mse_sum / samples).item(), (mae_sum / samples).item()
+
         for k in range(n_runs):
-            train_run_mse = []
-            train_run_mae = []
             train_run_cm = ConfusionMatrix(size=2, name='train')
-            val_run_mse = []
-            val_run_mae = []
             val_run_cm = ConfusionMatrix(size=2, name='val')
-            test_run_mse = []
-            test_run_mae = []
             test_run_cm = ConfusionMatrix(size=2, name='test')
 
-            with torch.no_grad():
-                # train
-                for img, age, gender in loader_train:
-                    img, age, gender = img.to(device), age, gender
-                    pred = model(img).cpu().detach()
-
-                    train_run_mse.append(mean_squared_error(y_true=age.numpy(), y_pred=pred[:, 1].numpy()))
-                    train_run_mae.append(mean_absolute_error(y_true=age.numpy(), y_pred=pred[:, 1].numpy()))
-                    train_run_cm.add(preds=(pred[:, 0] > 0).float(), labels=gender)
-
-                # valid
-                for img, age, gender in loader_valid:
-                    img, age, gender = img.to(device), age, gender
-                    pred = model(img).cpu().detach()
-
-                    val_run_mse.append(mean_squared_error(y_true=age.numpy(), y_pred=pred[:, 1].numpy()))
-                    val_run_mae.append(mean_absolute_error(y_true=age.numpy(), y_pred=pred[:, 1].numpy()))
-                    val_run_cm.add(preds=(pred[:, 0] > 0).float(), labels=gender)
-
-                # test
-                for img, age, gender in loader_test:
-                    img, age, gender = img.to(device), age, gender
-                    pred = model(img).cpu().detach()
-
-                    test_run_mse.append(mean_squared_error(y_true=age.numpy(), y_pred=pred[:, 1].numpy()))
-                    test_run_mae.append(mean_absolute_error(y_true=age.numpy(), y_pred=pred[:, 1].numpy()))
-                    test_run_cm.add(preds=(pred[:, 0] > 0).float(), labels=gender)
+            with torch.inference_mode():
+                train_run_mse, train_run_mae = run_loader(loader_train, train_run_cm)
+                val_run_mse, val_run_mae = run_loader(loader_valid, val_run_cm)
+                test_run_mse, test_run_mae = run_loader(loader_test, test_run_cm)
 
             print_v(f"Run {k}: {test_run_cm.global_accuracy}")
 
-            train_mse.append(np.mean(train_run_mse))
-            train_mae.append(np.mean(train_run_mae))
+            train_mse.append(train_run_mse)
+            train_mae.append(train_run_mae)
             train_cm.append(train_run_cm)
-            val_mse.append(np.mean(val_run_mse))
-            val_mae.append(np.mean(val_run_mae))
+            val_mse.append(val_run_mse)
+            val_mae.append(val_run_mae)
             val_cm.append(val_run_cm)
-            test_mse.append(np.mean(test_run_mse))
-            test_mae.append(np.mean(test_run_mae))
+            test_mse.append(test_run_mse)
+            test_mae.append(test_run_mae)
             test_cm.append(test_run_cm)
 
         dict_result = {
@@ -458,36 +560,40 @@ def predict_age_gender(
     # define threshold for prediction
     threshold = 0.5
 
-    # batch size cannot higher than length of images
-    if len(list_imgs) < batch_size:
-        batch_size = len(list_imgs)
-
     # Load model
     model = model.to(device)
     model.eval()
     img_size = int(model_dict['train_suffix'])
 
+    # load and resize the images with worker processes so decoding overlaps with the gpu
+    # (also keeps the trailing images when batch_size does not divide the input length).
+    # Worker count scales with the workload: a batch or less of images does not
+    # amortize the process startup, so small inputs decode in the main process
+    num_workers = 0 if len(list_imgs) <= batch_size else min(8, os.cpu_count(), len(list_imgs))
+    loader = torch.utils.data.DataLoader(
+        ImagePathDataset(list_imgs, (img_size, img_size)),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=device.type == 'cuda',
+    )
+
     predictions = []
-    for k in range(0, len(list_imgs) - batch_size + 1, batch_size):
-        # Load image batch and transform to correct size
-        images = list_imgs[k:k + batch_size]
-        img_tensor = []
-        for p in images:
-            img_tensor.append(get_image_transform((img_size,img_size))(Image.open(p)))
-        img_tensor = torch.stack(img_tensor, dim=0).to(device)
-
-        # Predict
-        pred = model(img_tensor)  # result (B, 2)
-        # return gender probabilities or predicted label
-        pred[:, 0] = torch.sigmoid(pred[:, 0])
-        if not return_pr:
-            pred[:, 0] = (pred[:, 0] > threshold).float()
-        predictions.append(pred.cpu().detach())
+    with torch.inference_mode():
+        for img_tensor in loader:
+            img_tensor = img_tensor.to(device, non_blocking=True)
+
+            # Predict
+            pred = model(img_tensor)  # result (B, 2)
+            # return gender probabilities or predicted label
+            pred[:, 0] = torch.sigmoid(pred[:, 0])
+            if not return_pr:
+                pred[:, 0] = (pred[:, 0] > threshold).float()
+            predictions.append(pred.cpu().detach())
 
     res = torch.cat(predictions, dim=0)
 
     # force positive ages
-    res[:,1] = res[:,1].square().sqrt()
+    res[:, 1].abs_()
     return res
 
 
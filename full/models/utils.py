@@ -41,15 +41,15 @@ class AgeGenderDataset(Dataset):
         Initializer for the dataset
         :param image_names: list of images of the dataset
         :param transform: transformations to be applied to the data when retrieved
-        :param use_cache: whether to save the training data after the first epoch to speed up training
+        :param use_cache: whether to keep the decoded images in memory after the first epoch
+                          to skip the jpeg decode on later epochs (one shared copy, filled
+                          and read by all loader workers)
         """
         # self.dataset_path = pathlib.Path(dataset_path)
         self.transform = transform
         self.to_tensor = transforms.ToTensor()
         self.image_names = image_names
         self.use_cache = use_cache
-        self.cache_folder = Path('./cache')
-        self.cache_folder.mkdir(exist_ok=True)
 
         # make sure that the data is correct
         image_tmp = image_names.copy()
@@ -59,6 +59,22 @@ class AgeGenderDataset(Dataset):
                 image_tmp.remove(self.image_names[k])
         self.image_names = image_tmp
 
+        # single flat shared-memory buffer holding every decoded image as uint8,
+        # allocated before the loader workers start so they all fill and read one copy
+        # (a per-worker cache would multiply the memory by the number of workers)
+        if use_cache:
+            # image dimensions come from the headers only, no full decode needed
+            self.cache_shapes = []
+            for name in self.image_names:
+                with Image.open(name) as image:
+                    width, height = image.size
+                self.cache_shapes.append((3, height, width))
+            self.cache_offsets = np.concatenate(([0], np.cumsum([3 * h * w for _, h, w in self.cache_shapes])))
+            self.cache = torch.empty(int(self.cache_offsets[-1]), dtype=torch.uint8).share_memory_()
+            self.cache_filled = torch.zeros(len(self.image_names), dtype=torch.bool).share_memory_()
+        else:
+            self.cache = None
+
     def __len__(self):
         """
         :return: the length of the dataset (how many images it has)
@@ -82,35 +98,74 @@ class AgeGenderDataset(Dataset):
         :param idx: index to retrieve
         :return: item retrieved (image: torch.Tensor, age: float, gender: float)
         """
-        path = self.cache_folder.joinpath(f"{self.image_names[idx].name}.th")
-        if self.use_cache and path.exists():
-            image = load_pickle(path)
+        if self.use_cache:
+            start, end = int(self.cache_offsets[idx]), int(self.cache_offsets[idx + 1])
+            cached = self.cache[start:end].view(self.cache_shapes[idx])
+            if self.cache_filled[idx]:
+                # skip the jpeg decode, only re-apply the (cheap) transformations
+                image = cached.float().div_(255)
+            else:
+                image = self.to_tensor(Image.open(self.image_names[idx]).convert('RGB'))
+                # stored as uint8 so the cache is 4x smaller than fp32; concurrent
+                # workers may fill the same slot, but they write identical bytes
+                cached.copy_((image * 255).to(torch.uint8))
+                self.cache_filled[idx] = True
         else:
             image = Image.open(self.image_names[idx]).convert('RGB')
-            # Apply transformation to image
             image = self.to_tensor(image)
-            if self.transform is not None:
-                image = self.transform(image)
 
-            if self.use_cache:
-                save_pickle(image, path)
+        # Apply transformation to image (outside the cache so augmentations stay random)
+        if self.transform is not None:
+            image = self.transform(image)
 
         # image, age, gender
         age, gender = self.get_target(idx)
         return image, np.float32(age), np.float32(gender)
 
 
+class ImagePathDataset(Dataset):
+    """
+    Class that represents a dataset over a list of image paths, used for batched prediction
+    """
+
+    def __init__(self, image_paths: List[str], size: Tuple[int, int]):
+        """
+        Initializer for the dataset
+        :param image_paths: list of paths of the images of the dataset
+        :param size: size (height, width) to which the images are resized
+        """
+        self.image_paths = image_paths
+        # built once here instead of once per image
+        self.transform = get_image_transform(size)
+
+    def __len__(self):
+        """
+        :return: the length of the dataset (how many images it has)
+        """
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        """
+        Returns an item from the dataset given the index
+        :param idx: index to retrieve
+        :return: image retrieved (torch.Tensor)
+        """
+        return self.transform(Image.open(self.image_paths[idx]).convert('RGB'))
+
+
 # todo add option to train cache
 
 def load_data(
         dataset_path,
-        num_workers=0,
+        num_workers=None,
         batch_size=32,
         drop_last=False,
         train_val_test_split=(0.7, 0.15, 0.15),
         random_seed=4444,
         train_transforms=None,
         test_transforms=None,
+        pin_memory=True,
+        prefetch_factor=4,
         **kwargs,
 ) -> tuple[DataLoader, ...]:
     """
@@ -120,15 +175,22 @@ def load_data(
     :param train_transforms: transformation to be applied to training data
     :param dataset_path: path to the dataset
     :param num_workers: how many subprocesses to use for data loading.
-                        0 means that the data will be loaded in the main process
+                        0 means that the data will be loaded in the main process,
+                        None defaults to min(8, cpu count)
     :param batch_size: size of each batch which is retrieved by the dataloader
     :param drop_last: whether to drop the last batch if it is smaller than batch_size
     :param train_val_test_split: tuple with percentage of train, validation and test samples
     :param random_seed: seed for the loaders
+    :param pin_memory: whether to use pinned host memory so batches can be copied to gpu asynchronously
+    :param prefetch_factor: number of batches loaded in advance by each worker (only used with workers)
 
     :return: tuple of dataloader (same length as parameter lengths)
     """
 
+    # default to one worker per core, capped to avoid queue/GIL contention
+    if num_workers is None:
+        num_workers = min(8, os.cpu_count())
+
     # Get list of images and randomly separate them
     image_names = list(pathlib.Path(dataset_path).glob('*.jpg'))
     np.random.default_rng(random_seed).shuffle(image_names)
@@ -143,8 +205,13 @@ def load_data(
     datasets.append(AgeGenderDataset(image_names[lengths[-1]:], transform=test_transforms, **kwargs))
 
     # Return DataLoaders for the datasets
+    # persistent_workers/prefetch_factor are only valid when using worker processes
+    loader_kwargs = dict(pin_memory=pin_memory)
+    if num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=prefetch_factor)
     return tuple(DataLoader(k, num_workers=num_workers, batch_size=batch_size, shuffle=True,
-                            drop_last=drop_last and idx != len(datasets) - 1) for idx, k in enumerate(datasets))
+                            drop_last=drop_last and idx != len(datasets) - 1, **loader_kwargs)
+                 for idx, k in enumerate(datasets))
 
 
 class ConfusionMatrix:
@@ -161,10 +228,11 @@ class ConfusionMatrix:
         :param labels: true values (B)
         :return: (size,size) confusion matrix of `size` classes
         """
-        matrix = torch.zeros(self.size, self.size, dtype=torch.float)
-        for t, p in zip(labels.reshape(-1).long(), preds.reshape(-1).long()):
-            matrix[t, p] += 1
-        return matrix
+        # one bincount over size*labels+preds instead of a python loop per sample
+        preds = preds.reshape(-1).long()
+        labels = labels.reshape(-1).long().to(preds.device)
+        counts = torch.bincount(labels * self.size + preds, minlength=self.size * self.size)
+        return counts.reshape(self.size, self.size).float()
 
     def __init__(self, size=5, name: str = ''):
         """
@@ -186,10 +254,12 @@ class ConfusionMatrix:
         :param preds: predicted values (B)
         :param labels: true values (B)
         """
+        # the update is built on whatever device the predictions live on, so only
+        # a single (size, size) count tensor crosses to the host per batch
+        self.matrix += self._make(preds, labels).cpu()
+
         preds = preds.reshape(-1).cpu().detach().clone()
         labels = labels.reshape(-1).cpu().detach().clone()
-
-        self.matrix += self._make(preds, labels)
         self.preds = torch.cat((self.preds, preds), dim=0) if self.preds is not None else preds
         self.labels = torch.cat((self.labels, labels), dim=0) if self.labels is not None else labels
 